@@ -0,0 +1,94 @@
+/*
+ * Closest sphere hit by a batch of rays, for the NumPy renderer of rt.py.
+ *
+ * Build it next to rt.py, which loads it when it is there:
+ *
+ *     gcc -O3 -mavx2 -mfma -shared -fPIC -o intersect.so intersect.c
+ *
+ * Do not add -ffast-math: missed rays are encoded as +inf. Without -mavx2 the
+ * scalar loop is used for all the rays.
+ */
+
+#include <math.h>
+#ifdef __AVX2__
+#include <immintrin.h>
+#endif
+
+/*
+ * Rays are stored as (3, n) arrays: rayO holds the x, y and z of the origins
+ * one after the other, and rayD the normalized directions. Spheres are given
+ * by their (k, 3) centers sp and (k,) radii sr. For each ray i, write the
+ * distance to the closest sphere in out_t[i] and its index in out_idx[i], or
+ * +inf and -1 if the ray misses all of them. Ray i ignores sphere skip[i].
+ * Same geometric solution as intersect_spheres() in rt.py.
+ */
+void intersect_spheres_avx2(const float *rayO, const float *rayD, int n,
+                            const float *sp, const float *sr, int k,
+                            const int *skip, float *out_t, int *out_idx)
+{
+    int i = 0;
+#ifdef __AVX2__
+    const __m256 zero = _mm256_setzero_ps();
+    const __m256 inf = _mm256_set1_ps(INFINITY);
+    for (; i + 8 <= n; i += 8) {
+        __m256 ox = _mm256_loadu_ps(rayO + i);
+        __m256 oy = _mm256_loadu_ps(rayO + n + i);
+        __m256 oz = _mm256_loadu_ps(rayO + 2 * n + i);
+        __m256 dx = _mm256_loadu_ps(rayD + i);
+        __m256 dy = _mm256_loadu_ps(rayD + n + i);
+        __m256 dz = _mm256_loadu_ps(rayD + 2 * n + i);
+        __m256i sk = _mm256_loadu_si256((const __m256i *)(skip + i));
+        __m256 t = inf;
+        __m256 idx = _mm256_castsi256_ps(_mm256_set1_epi32(-1));
+        for (int j = 0; j < k; j++) {
+            __m256 osx = _mm256_sub_ps(_mm256_set1_ps(sp[3 * j]), ox);
+            __m256 osy = _mm256_sub_ps(_mm256_set1_ps(sp[3 * j + 1]), oy);
+            __m256 osz = _mm256_sub_ps(_mm256_set1_ps(sp[3 * j + 2]), oz);
+            __m256 r2 = _mm256_set1_ps(sr[j] * sr[j]);
+            __m256 tca = _mm256_fmadd_ps(dz, osz,
+                _mm256_fmadd_ps(dy, osy, _mm256_mul_ps(dx, osx)));
+            __m256 oslen2 = _mm256_fmadd_ps(osz, osz,
+                _mm256_fmadd_ps(osy, osy, _mm256_mul_ps(osx, osx)));
+            __m256 d2 = _mm256_fnmadd_ps(tca, tca, oslen2);
+            __m256 thc = _mm256_sqrt_ps(_mm256_max_ps(_mm256_sub_ps(r2, d2), zero));
+            __m256 t0 = _mm256_sub_ps(tca, thc);
+            __m256 t1 = _mm256_add_ps(tca, thc);
+            /* Closest root in front of the origin. */
+            __m256 tj = _mm256_blendv_ps(inf, t1, _mm256_cmp_ps(t1, zero, _CMP_GE_OQ));
+            tj = _mm256_blendv_ps(tj, t0, _mm256_cmp_ps(t0, zero, _CMP_GE_OQ));
+            /* Keep it if the ray hits the sphere, closer than before. */
+            __m256 skipped = _mm256_castsi256_ps(
+                _mm256_cmpeq_epi32(sk, _mm256_set1_epi32(j)));
+            __m256 closer = _mm256_andnot_ps(skipped, _mm256_and_ps(
+                _mm256_cmp_ps(d2, r2, _CMP_LE_OQ), _mm256_cmp_ps(tj, t, _CMP_LT_OQ)));
+            t = _mm256_blendv_ps(t, tj, closer);
+            idx = _mm256_blendv_ps(idx, _mm256_castsi256_ps(_mm256_set1_epi32(j)), closer);
+        }
+        _mm256_storeu_ps(out_t + i, t);
+        _mm256_storeu_si256((__m256i *)(out_idx + i), _mm256_castps_si256(idx));
+    }
+#endif
+    /* Remaining rays. */
+    for (; i < n; i++) {
+        float ox = rayO[i], oy = rayO[n + i], oz = rayO[2 * n + i];
+        float dx = rayD[i], dy = rayD[n + i], dz = rayD[2 * n + i];
+        float t = INFINITY;
+        int idx = -1;
+        for (int j = 0; j < k; j++) {
+            float osx = sp[3 * j] - ox, osy = sp[3 * j + 1] - oy, osz = sp[3 * j + 2] - oz;
+            float r2 = sr[j] * sr[j];
+            float tca = dx * osx + dy * osy + dz * osz;
+            float d2 = osx * osx + osy * osy + osz * osz - tca * tca;
+            if (j == skip[i] || d2 > r2)
+                continue;
+            float thc = sqrtf(r2 - d2);
+            float tj = tca - thc >= 0 ? tca - thc : (tca + thc >= 0 ? tca + thc : INFINITY);
+            if (tj < t) {
+                t = tj;
+                idx = j;
+            }
+        }
+        out_t[i] = t;
+        out_idx[i] = idx;
+    }
+}
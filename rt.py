@@ -18,122 +18,440 @@ OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
 SOFTWARE.
 """
 
+import ctypes
+import os
+from concurrent.futures import ProcessPoolExecutor
+
 import numpy as np
 import matplotlib.pyplot as plt
 
+try:
+    from numba import njit, prange
+    has_numba = True
+except ImportError:
+    # Without Numba, render with the NumPy batched rays only.
+    has_numba = False
+    def njit(*args, **kwargs):
+        return lambda f: f
+    prange = range
+
+try:
+    import cupy as xp
+    xp.cuda.runtime.getDeviceCount()
+    has_cupy = True
+except (ImportError, RuntimeError):
+    # Without CuPy or a CUDA device, the batched renderer runs on NumPy.
+    xp = np
+    has_cupy = False
+
+# Optional C kernel for the NumPy renderer, see intersect.c to build it.
+try:
+    lib = np.ctypeslib.load_library('intersect', os.path.dirname(os.path.abspath(__file__)))
+except OSError:
+    lib = None
+else:
+    _f32 = np.ctypeslib.ndpointer(np.float32, flags='C_CONTIGUOUS')
+    _i32 = np.ctypeslib.ndpointer(np.int32, flags='C_CONTIGUOUS')
+    lib.intersect_spheres_avx2.argtypes = [_f32, _f32, ctypes.c_int, _f32, _f32,
+                                           ctypes.c_int, _i32, _f32, _i32]
+    lib.intersect_spheres_avx2.restype = None
+
 w = 400
 h = 300
 
+# Fast-math flags for the JIT kernels; 'nnan' and 'ninf' are left out since
+# missed rays are encoded as +inf.
+fastmath = {'nsz', 'arcp', 'contract', 'afn', 'reassoc'}
+
 def normalize(x):
-    x /= np.linalg.norm(x)
-    return x
-
-def intersect_plane(O, D, P, N):
-    # Return the distance from O to the intersection of the ray (O, D) with the 
-    # plane (P, N), or +inf if there is no intersection.
-    # O and P are 3D points, D and N (normal) are normalized vectors.
-    denom = np.dot(D, N)
-    if np.abs(denom) < 1e-6:
-        return np.inf
-    d = np.dot(P - O, N) / denom
-    if d < 0:
-        return np.inf
-    return d
+    return x / xp.linalg.norm(x, axis=-1, keepdims=True)
+
+def reflect(D, N):
+    # Reflect the (n, 3) directions D about the normals N, in place.
+    D -= 2 * dot(D, N)[:, np.newaxis] * N
+    D /= xp.linalg.norm(D, axis=-1, keepdims=True)
+    return D
+
+def power(x, k):
+    # Return x ** k for an integer k >= 0 by repeated squaring, which takes
+    # a few multiplications instead of the exp and log of a float power.
+    y = 1.
+    while k:
+        if k & 1:
+            y = y * x
+        k >>= 1
+        if k:
+            x = x * x
+    return y
+
+power_jit = njit(cache=True, fastmath=fastmath)(power)
 
-def intersect_sphere(O, D, S, R):
-    # Return the distance from O to the intersection of the ray (O, D) with the 
-    # sphere (S, R), or +inf if there is no intersection.
-    # O and S are 3D points, D (direction) is a normalized vector, R is a scalar.
-    a = np.dot(D, D)
-    OS = O - S
-    b = 2 * np.dot(D, OS)
-    c = np.dot(OS, OS) - R * R
-    disc = b * b - 4 * a * c
-    if disc > 0:
-        distSqrt = np.sqrt(disc)
-        q = (-b - distSqrt) / 2.0 if b < 0 else (-b + distSqrt) / 2.0
-        t0 = q / a
-        t1 = c / q
-        t0, t1 = min(t0, t1), max(t0, t1)
-        if t1 >= 0:
-            return t1 if t0 < 0 else t0
-    return np.inf
-
-def intersect(O, D, obj):
-    if obj['type'] == 'plane':
-        return intersect_plane(O, D, obj['position'], obj['normal'])
-    elif obj['type'] == 'sphere':
-        return intersect_sphere(O, D, obj['position'], obj['radius'])
-
-def get_normal(obj, M):
-    # Find normal.
-    if obj['type'] == 'sphere':
-        N = normalize(M - obj['position'])
-    elif obj['type'] == 'plane':
-        N = obj['normal']
+def dot(x, y):
+    # Row-wise dot product of two (n, 3) arrays.
+    return xp.einsum('ij,ij->i', x, y)
+
+def intersect_planes(O, D, P, N, axis):
+    # Return the distances from O to the intersections of the rays (O, D) with 
+    # the planes (P, N), or +inf where there is no intersection.
+    # O and D are (n, 3) arrays of ray origins and normalized directions,
+    # P and N are (k, 3) arrays of points and normals; the result is (n, k).
+    # axis is the (k,) array from plane_axis(N): when all the planes are
+    # normal to a coordinate axis, the dot products are just coordinates.
+    if (axis >= 0).all():
+        denom = D[:, axis]
+        num = P[xp.arange(len(P)), axis] - O[:, axis]
+    else:
+        denom = D.dot(N.T)
+        num = xp.einsum('ki,ki->k', P, N) - O.dot(N.T)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        d = num / denom
+    return xp.where((xp.abs(denom) < 1e-6) | (d < 0), np.inf, d)
+
+def intersect_spheres(O, D, S, R):
+    # Return the distances from O to the intersections of the rays (O, D) with 
+    # the spheres (S, R), or +inf where there is no intersection.
+    # O and D are (n, 3) arrays of ray origins and normalized directions,
+    # S is a (k, 3) array of centers and R a (k,) array of radii; the result
+    # is (n, k).
+    # Geometric solution: tca is the distance along the ray to the point
+    # closest to the center, d2 the squared distance from that point to the
+    # center.
+    OS = S[np.newaxis, :, :] - O[:, np.newaxis, :]
+    tca = xp.einsum('ni,nki->nk', D, OS)
+    d2 = xp.einsum('nki,nki->nk', OS, OS) - tca * tca
+    thc = xp.sqrt(xp.maximum(R * R - d2, 0))
+    # Take the closest root in front of O, without branching on the rays.
+    t0, t1 = tca - thc, tca + thc
+    t = xp.where(t0 >= 0, t0, xp.where(t1 >= 0, t1, np.inf))
+    return xp.where(d2 <= R * R, t, np.inf)
+
+def intersect(O, D):
+    # Return the (n, objects) distances to all the objects of the scene,
+    # spheres first then planes.
+    return xp.hstack([intersect_spheres(O, D, spheres['position'], spheres['radius']),
+                      intersect_planes(O, D, planes['position'], planes['normal'],
+                                       planes['axis'])])
+
+def intersect_spheres_c(O, D, S, R, skip):
+    # Return the distances to the closest of the spheres (S, R) and its index,
+    # or +inf and -1, ignoring sphere skip[i] for ray i; with the C kernel.
+    n = len(D)
+    t, idx = np.empty(n, dtype=np.float32), np.empty(n, dtype=np.int32)
+    lib.intersect_spheres_avx2(
+        np.ascontiguousarray(np.broadcast_to(O, D.shape).T, dtype=np.float32),
+        np.ascontiguousarray(D.T, dtype=np.float32), n,
+        np.ascontiguousarray(S, dtype=np.float32),
+        np.ascontiguousarray(R, dtype=np.float32), len(R),
+        np.ascontiguousarray(skip, dtype=np.int32), t, idx)
+    return t, idx
+
+def intersect_closest(O, D, skip=None):
+    # Return the distance to the closest object hit by each ray, or +inf, and
+    # its index, numbered like the columns of intersect(). If given, ray i
+    # ignores the object skip[i].
+    rows = xp.arange(len(D))
+    if lib is None or xp is not np:
+        t_obj = intersect(O, D)
+        if skip is not None:
+            t_obj[rows, skip] = np.inf
+        obj_idx = xp.argmin(t_obj, axis=1)
+        return t_obj[rows, obj_idx], obj_idx
+    if skip is None:
+        skip = np.full(len(D), -1)
+    t, obj_idx = intersect_spheres_c(O, D, spheres['position'], spheres['radius'], skip)
+    t_pl = intersect_planes(O, D, planes['position'], planes['normal'], planes['axis'])
+    t_pl[skip[:, np.newaxis] - n_spheres == np.arange(t_pl.shape[1])] = np.inf
+    pl_idx = np.argmin(t_pl, axis=1)
+    t_pl = t_pl[rows, pl_idx]
+    closer = t_pl < t
+    return np.where(closer, t_pl, t), np.where(closer, pl_idx + n_spheres, obj_idx)
+
+def get_normal(obj_idx, M, sph):
+    # Find normal. sph is the mask of the points on spheres, the others are
+    # on planes.
+    pl = ~sph
+    N = xp.empty_like(M)
+    N[sph] = normalize(M[sph] - spheres['position'][obj_idx[sph]])
+    N[pl] = planes['normal'][obj_idx[pl] - n_spheres]
     return N
     
-def get_color(obj, M):
-    color = obj['color']
-    if not hasattr(color, '__len__'):
-        color = color(M)
+def get_color(obj_idx, M, sph):
+    # Spheres have a plain color, planes a checkerboard pattern.
+    pl = ~sph
+    color = xp.empty_like(M)
+    color[sph] = spheres['color'][obj_idx[sph]]
+    Mp = M[pl] * 2
+    checker = (Mp[:, 0].astype(np.int32) & 1) == (Mp[:, 2].astype(np.int32) & 1)
+    color[pl] = xp.where(checker[:, np.newaxis], color_plane0, color_plane1)
     return color
 
 def trace_ray(rayO, rayD):
-    # Find first point of intersection with the scene.
-    t = np.inf
-    for i, obj in enumerate(scene):
-        t_obj = intersect(rayO, rayD, obj)
-        if t_obj < t:
-            t, obj_idx = t_obj, i
-    # Return None if the ray does not intersect any object.
-    if t == np.inf:
-        return
-    # Find the object.
-    obj = scene[obj_idx]
+    # Find first point of intersection with the scene, for all rays at once.
+    t, obj_idx = intersect_closest(rayO, rayD)
+    # Only keep the rays that intersect an object.
+    hit = t < np.inf
+    rayO, rayD, t, obj_idx = rayO[hit], rayD[hit], t[hit], obj_idx[hit]
     # Find the point of intersection on the object.
-    M = rayO + rayD * t
-    # Find properties of the object.
-    N = get_normal(obj, M)
-    color = get_color(obj, M)
+    M = rayO + rayD * t[:, np.newaxis]
+    # Find properties of the objects.
+    # Objects are numbered spheres first, then planes.
+    sph = obj_idx < n_spheres
+    N = get_normal(obj_idx, M, sph)
+    color = get_color(obj_idx, M, sph)
     toL = normalize(L - M)
     toO = normalize(O - M)
-    # Shadow: find if the point is shadowed or not.
-    l = [intersect(M + N * .0001, toL, obj_sh) 
-            for k, obj_sh in enumerate(scene) if k != obj_idx]
-    if l and min(l) < np.inf:
-        return
+    # Move the points off the surface along the normal, they are the origins
+    # of both the shadow rays and the reflected rays.
+    M += N * .0001
+    # Shadow: find if the points are shadowed or not, ignoring the object
+    # the point lies on.
+    t_sh, _ = intersect_closest(M, toL, obj_idx)
+    lit = t_sh == np.inf
+    # Drop the shadowed points like the rays that missed, before shading.
+    hit[hit] = lit
+    obj_idx, M, N, color, toL, toO = obj_idx[lit], M[lit], N[lit], color[lit], toL[lit], toO[lit]
+    diffuse, specular, reflection = obj_material[obj_idx].T
     # Start computing the color.
     col_ray = ambient
     # Lambert shading (diffuse).
-    col_ray += obj.get('diffuse_c', diffuse_c) * max(np.dot(N, toL), 0) * color
+    col_ray += (diffuse * xp.maximum(dot(N, toL), 0))[:, np.newaxis] * color
     # Blinn-Phong shading (specular).
-    col_ray += obj.get('specular_c', specular_c) * max(np.dot(N, normalize(toL + toO)), 0) ** specular_k * color_light
-    return obj, M, N, col_ray
+    col_ray += (specular * power(xp.maximum(dot(N, normalize(toL + toO)), 0), specular_k))[:, np.newaxis] * color_light
+    # Return the mask of the remaining rays along with their properties and
+    # the origins of the reflected rays.
+    return hit, M, N, col_ray, reflection
+
+def cast_ray(rayO, rayD):
+    # Return the color of the rays (rayO, rayD), following their reflections.
+    # All the rays still alive are traced together at each bounce, the ones
+    # that miss the scene or hit a shadowed point are dropped.
+    out = xp.zeros(rayD.shape, dtype=rayD.dtype)
+    throughput = xp.ones(len(rayD), dtype=rayD.dtype)
+    alive = xp.arange(len(rayD))  # Indices of the rays still alive.
+    # Loop through initial and secondary rays.
+    for depth in range(depth_max):
+        hit, M, N, col_ray, reflection = trace_ray(rayO, rayD)
+        alive, rayD, throughput = alive[hit], rayD[hit], throughput[hit]
+        if not len(alive):
+            break
+        out[alive] += throughput[:, np.newaxis] * col_ray
+        throughput *= reflection
+        # Drop the rays whose reflections would barely contribute.
+        bright = throughput >= throughput_min
+        if not bright.all():
+            alive, throughput = alive[bright], throughput[bright]
+            rayD, M, N = rayD[bright], M[bright], N[bright]
+        # Reflection: create new rays.
+        rayO, rayD = M, reflect(rayD, N)
+    return out
+
+@njit(cache=True, fastmath=fastmath)
+def intersect_plane_jit(ox, oy, oz, dx, dy, dz, px, py, pz, nx, ny, nz):
+    # Scalar version of intersect_planes() for one ray and one plane.
+    denom = dx * nx + dy * ny + dz * nz
+    if abs(denom) < 1e-6:
+        return np.inf
+    d = ((px - ox) * nx + (py - oy) * ny + (pz - oz) * nz) / denom
+    if d < 0:
+        return np.inf
+    return d
+
+@njit(cache=True, fastmath=fastmath, error_model='numpy')
+def intersect_sphere_jit(ox, oy, oz, dx, dy, dz, sx, sy, sz, R):
+    # Scalar version of intersect_spheres() for one ray and one sphere. Most
+    # misses are rejected before the square root: spheres behind O, unless O
+    # is inside, and spheres farther from the ray than their radius.
+    osx, osy, osz = sx - ox, sy - oy, sz - oz
+    tca = dx * osx + dy * osy + dz * osz
+    oslen2 = osx * osx + osy * osy + osz * osz
+    R2 = R * R
+    if tca < 0 and oslen2 > R2:
+        return np.inf
+    d2 = oslen2 - tca * tca
+    if d2 > R2:
+        return np.inf
+    thc = np.sqrt(R2 - d2)
+    t = tca - thc
+    return t if t >= 0 else tca + thc
+
+@njit(cache=True, fastmath=fastmath, error_model='numpy')
+def intersect_aabb_jit(ox, oy, oz, ix, iy, iz, bmin, bmax):
+    # Return the distance from O to the box (bmin, bmax) along the ray of
+    # inverse direction (ix, iy, iz), or +inf if the ray misses the box.
+    # The entry distance is 0 if O is inside the box.
+    tx0, tx1 = (bmin[0] - ox) * ix, (bmax[0] - ox) * ix
+    ty0, ty1 = (bmin[1] - oy) * iy, (bmax[1] - oy) * iy
+    tz0, tz1 = (bmin[2] - oz) * iz, (bmax[2] - oz) * iz
+    tmin = max(max(min(tx0, tx1), min(ty0, ty1)), max(min(tz0, tz1), 0.))
+    tmax = min(min(max(tx0, tx1), max(ty0, ty1)), max(tz0, tz1))
+    return tmin if tmin <= tmax else np.inf
+
+@njit(cache=True, fastmath=fastmath, error_model='numpy')
+def intersect_jit(ox, oy, oz, dx, dy, dz, ix, iy, iz, sphere_pos, sphere_r,
+                  plane_pos, plane_normal, bvh, stack, skip):
+    # Return the distance to the closest object hit by the ray and its index
+    # (numbered like the columns of intersect()), ignoring the object `skip`.
+    # The spheres are found by walking the BVH front to back, using the
+    # inverse ray direction (ix, iy, iz) and `stack` as scratch space.
+    bvh_bmin, bvh_bmax, bvh_left, bvh_right, bvh_sphere = bvh
+    t, obj_idx = np.inf, -1
+    if len(bvh_sphere):
+        stack[0], n = 0, 1
+        while n:
+            n -= 1
+            i = stack[n]
+            k = bvh_sphere[i]
+            if k >= 0:
+                if k != skip:
+                    t_obj = intersect_sphere_jit(ox, oy, oz, dx, dy, dz, sphere_pos[k, 0],
+                        sphere_pos[k, 1], sphere_pos[k, 2], sphere_r[k])
+                    if t_obj < t:
+                        t, obj_idx = t_obj, k
+                continue
+            # Visit the closest child first, and skip the children farther
+            # than the current hit.
+            near, far = bvh_left[i], bvh_right[i]
+            t_near = intersect_aabb_jit(ox, oy, oz, ix, iy, iz, bvh_bmin[near], bvh_bmax[near])
+            t_far = intersect_aabb_jit(ox, oy, oz, ix, iy, iz, bvh_bmin[far], bvh_bmax[far])
+            if t_far < t_near:
+                near, far, t_near, t_far = far, near, t_far, t_near
+            if t_far < t:
+                stack[n], n = far, n + 1
+            if t_near < t:
+                stack[n], n = near, n + 1
+    for k in range(len(plane_pos)):
+        if k + len(sphere_r) != skip:
+            t_obj = intersect_plane_jit(ox, oy, oz, dx, dy, dz, plane_pos[k, 0],
+                plane_pos[k, 1], plane_pos[k, 2], plane_normal[k, 0],
+                plane_normal[k, 1], plane_normal[k, 2])
+            if t_obj < t:
+                t, obj_idx = t_obj, k + len(sphere_r)
+    return t, obj_idx
+
+@njit(cache=True, fastmath=fastmath, error_model='numpy', parallel=True)
+def cast_ray_jit(O, rayD, sphere_pos, sphere_r, sphere_color, plane_pos,
+                 plane_normal, bvh, obj_material, L, color_light, color_plane0,
+                 color_plane1):
+    # Same as cast_ray(), for rays starting from O, with one ray per thread
+    # iteration and all the arithmetic done on scalars.
+    n_spheres = len(sphere_r)
+    out = np.zeros(rayD.shape, dtype=rayD.dtype)
+    for p in prange(len(rayD)):
+        stack = np.empty(64, np.int64)
+        ox, oy, oz = O[0], O[1], O[2]
+        dx, dy, dz = rayD[p, 0], rayD[p, 1], rayD[p, 2]
+        # The inverse direction is kept along with the direction of each ray,
+        # for the BVH box tests.
+        ix, iy, iz = 1. / dx, 1. / dy, 1. / dz
+        throughput = 1.
+        # Loop through initial and secondary rays.
+        for depth in range(depth_max):
+            t, k = intersect_jit(ox, oy, oz, dx, dy, dz, ix, iy, iz, sphere_pos,
+                                 sphere_r, plane_pos, plane_normal, bvh, stack, -1)
+            if k < 0:
+                break
+            # Find the point of intersection on the object.
+            mx, my, mz = ox + dx * t, oy + dy * t, oz + dz * t
+            # Find properties of the object.
+            if k < n_spheres:
+                nx = mx - sphere_pos[k, 0]
+                ny = my - sphere_pos[k, 1]
+                nz = mz - sphere_pos[k, 2]
+                norm = np.sqrt(nx * nx + ny * ny + nz * nz)
+                nx, ny, nz = nx / norm, ny / norm, nz / norm
+                cr, cg, cb = sphere_color[k, 0], sphere_color[k, 1], sphere_color[k, 2]
+            else:
+                nx = plane_normal[k - n_spheres, 0]
+                ny = plane_normal[k - n_spheres, 1]
+                nz = plane_normal[k - n_spheres, 2]
+                if (int(mx * 2) & 1) == (int(mz * 2) & 1):
+                    cr, cg, cb = color_plane0[0], color_plane0[1], color_plane0[2]
+                else:
+                    cr, cg, cb = color_plane1[0], color_plane1[1], color_plane1[2]
+            lx, ly, lz = L[0] - mx, L[1] - my, L[2] - mz
+            norm = np.sqrt(lx * lx + ly * ly + lz * lz)
+            ilx, ily, ilz = norm / lx, norm / ly, norm / lz
+            lx, ly, lz = lx / norm, ly / norm, lz / norm
+            vx, vy, vz = O[0] - mx, O[1] - my, O[2] - mz
+            norm = np.sqrt(vx * vx + vy * vy + vz * vz)
+            vx, vy, vz = vx / norm, vy / norm, vz / norm
+            # Move the point off the surface, for the shadow and reflected rays.
+            mx, my, mz = mx + nx * .0001, my + ny * .0001, mz + nz * .0001
+            # Shadow: find if the point is shadowed or not.
+            t_sh, k_sh = intersect_jit(mx, my, mz, lx, ly, lz, ilx, ily, ilz,
+                                       sphere_pos, sphere_r, plane_pos,
+                                       plane_normal, bvh, stack, k)
+            if k_sh >= 0:
+                break
+            # Lambert shading (diffuse).
+            diffuse = obj_material[k, 0] * max(nx * lx + ny * ly + nz * lz, 0)
+            # Blinn-Phong shading (specular).
+            hx, hy, hz = lx + vx, ly + vy, lz + vz
+            norm = np.sqrt(hx * hx + hy * hy + hz * hz)
+            specular = obj_material[k, 1] * power_jit(max((nx * hx + ny * hy + nz * hz) / norm, 0), specular_k)
+            out[p, 0] += throughput * (ambient + diffuse * cr + specular * color_light[0])
+            out[p, 1] += throughput * (ambient + diffuse * cg + specular * color_light[1])
+            out[p, 2] += throughput * (ambient + diffuse * cb + specular * color_light[2])
+            throughput *= obj_material[k, 2]
+            if throughput < throughput_min:
+                break
+            # Reflection: create a new ray.
+            ox, oy, oz = mx, my, mz
+            dot_DN = dx * nx + dy * ny + dz * nz
+            dx, dy, dz = dx - 2 * dot_DN * nx, dy - 2 * dot_DN * ny, dz - 2 * dot_DN * nz
+            norm = np.sqrt(dx * dx + dy * dy + dz * dz)
+            ix, iy, iz = norm / dx, norm / dy, norm / dz
+            dx, dy, dz = dx / norm, dy / norm, dz / norm
+    return out
 
 def add_sphere(position, radius, color):
-    return dict(type='sphere', position=np.array(position), 
-        radius=np.array(radius), color=np.array(color), reflection=.5)
+    return dict(position=position, radius=radius, color=color,
+        diffuse_c=diffuse_c, specular_c=specular_c, reflection=.5)
     
 def add_plane(position, normal):
-    return dict(type='plane', position=np.array(position), 
-        normal=np.array(normal),
-        color=lambda M: (color_plane0 
-            if (int(M[0] * 2) % 2) == (int(M[2] * 2) % 2) else color_plane1),
+    return dict(position=position, normal=normal,
         diffuse_c=.75, specular_c=.5, reflection=.25)
-    
-# List of objects.
-color_plane0 = 1. * np.ones(3)
-color_plane1 = 0. * np.ones(3)
-scene = [add_sphere([.75, .1, 1.], .6, [0., 0., 1.]),
-         add_sphere([-.75, .1, 2.25], .6, [.5, .223, .5]),
-         add_sphere([-2.75, .1, 3.5], .6, [1., .572, .184]),
-         add_plane([0., -.5, 0.], [0., 1., 0.]),
-    ]
+
+def build_bvh(S, R):
+    # Build a bounding volume hierarchy over the spheres (S, R), splitting the
+    # boxes at the median sphere along their longest axis, with one sphere per
+    # leaf. Nodes are stored in flat arrays, the root first: box corners, left
+    # and right children, and sphere index of the leaves (-1 for inner nodes).
+    bmin, bmax, left, right, sphere = [], [], [], [], []
+    def build(idx):
+        i = len(sphere)
+        bmin.append((S[idx] - R[idx, np.newaxis]).min(axis=0))
+        bmax.append((S[idx] + R[idx, np.newaxis]).max(axis=0))
+        left.append(-1)
+        right.append(-1)
+        sphere.append(idx[0] if len(idx) == 1 else -1)
+        if len(idx) > 1:
+            idx = idx[np.argsort(S[idx, np.argmax(bmax[i] - bmin[i])])]
+            left[i] = build(idx[:len(idx) // 2])
+            right[i] = build(idx[len(idx) // 2:])
+        return i
+    if len(R):
+        build(np.arange(len(R)))
+    return (np.array(bmin, dtype=S.dtype).reshape(-1, 3),
+            np.array(bmax, dtype=S.dtype).reshape(-1, 3),
+            np.array(left, dtype=np.int64), np.array(right, dtype=np.int64),
+            np.array(sphere, dtype=np.int64))
+
+def plane_axis(N):
+    # Return, for each of the (k, 3) normals N, the index of the coordinate
+    # axis it lies along, or -1 if it is not along an axis.
+    along = np.count_nonzero(N, axis=1) == 1
+    return np.where(along, np.argmax(np.abs(N), axis=1), -1)
+
+def make_table(objects):
+    # Store a list of objects as one array per property, one row per object.
+    # Single precision is plenty for an 8-bit image and halves memory traffic.
+    return {key: np.array([obj[key] for obj in objects], dtype=np.float32)
+            for key in objects[0]}
 
 # Light position and color.
-L = np.array([5., 5., -10.])
-color_light = np.ones(3)
+L = np.array([5., 5., -10.], dtype=np.float32)
+color_light = np.ones(3, dtype=np.float32)
 
 # Default light and material parameters.
 ambient = .05
@@ -141,38 +459,73 @@ diffuse_c = 1.
 specular_c = 1.
 specular_k = 50
 
+# List of objects.
+color_plane0 = 1. * np.ones(3, dtype=np.float32)
+color_plane1 = 0. * np.ones(3, dtype=np.float32)
+spheres = make_table([add_sphere([.75, .1, 1.], .6, [0., 0., 1.]),
+                      add_sphere([-.75, .1, 2.25], .6, [.5, .223, .5]),
+                      add_sphere([-2.75, .1, 3.5], .6, [1., .572, .184]),
+    ])
+planes = make_table([add_plane([0., -.5, 0.], [0., 1., 0.]),
+    ])
+planes['axis'] = plane_axis(planes['normal'])
+n_spheres = len(spheres['radius'])
+bvh = build_bvh(spheres['position'], spheres['radius'])
+# Material properties indexed like the columns of intersect(), one row per
+# object: diffuse_c, specular_c and reflection.
+obj_material = np.stack([np.concatenate([spheres[key], planes[key]])
+                         for key in ('diffuse_c', 'specular_c', 'reflection')], axis=1)
+
 depth_max = 5  # Maximum number of light reflections.
-col = np.zeros(3)  # Current color.
-O = np.array([0., 0.35, -1.])  # Camera.
-Q = np.array([0., 0., 0.])  # Camera pointing to.
-img = np.zeros((h, w, 3))
+throughput_min = 1e-3  # Rays dimmer than this are not reflected anymore.
+O = np.array([0., 0.35, -1.], dtype=np.float32)  # Camera.
+Q = np.array([0., 0., 0.], dtype=np.float32)  # Camera pointing to.
 
 r = float(w) / h
 # Screen coordinates: x0, y0, x1, y1.
 S = (-1., -1. / r + .25, 1., 1. / r + .25)
 
-# Loop through all pixels.
-for i, x in enumerate(np.linspace(S[0], S[2], w)):
-    if i % 10 == 0:
-        print i / float(w) * 100, "%"
-    for j, y in enumerate(np.linspace(S[1], S[3], h)):
-        col[:] = 0
-        Q[:2] = (x, y)
-        D = normalize(Q - O)
-        depth = 0
-        rayO, rayD = O, D
-        reflection = 1.
-        # Loop through initial and secondary rays.
-        while depth < depth_max:
-            traced = trace_ray(rayO, rayD)
-            if not traced:
-                break
-            obj, M, N, col_ray = traced
-            # Reflection: create a new ray.
-            rayO, rayD = M + N * .0001, normalize(rayD - 2 * np.dot(rayD, N) * N)
-            depth += 1
-            col += reflection * col_ray
-            reflection *= obj.get('reflection', 1.)
-        img[h - j - 1, i, :] = np.clip(col, 0, 1)
+# Primary ray directions, from the camera to each pixel of the screen.
+X, Y = np.meshgrid(np.linspace(S[0], S[2], w, dtype=np.float32),
+                   np.linspace(S[1], S[3], h, dtype=np.float32))
+D = np.stack([X - O[0], Y - O[1], np.full_like(X, Q[2] - O[2])], axis=-1)
+D /= np.linalg.norm(D, axis=-1, keepdims=True)
+
+def render_strip(j0, j1):
+    # Return the colors of the screen rows j0 to j1, with the NumPy renderer.
+    rayD = D[j0:j1].reshape(-1, 3)
+    return cast_ray(np.broadcast_to(O, rayD.shape), rayD)
+
+if __name__ == '__main__':
+    if has_cupy:
+        # Trace all the pixels at once on the GPU, with the scene copied to
+        # the device first.
+        for table in (spheres, planes):
+            for key in table:
+                table[key] = xp.asarray(table[key])
+        obj_material, L, O = xp.asarray(obj_material), xp.asarray(L), xp.asarray(O)
+        color_light = xp.asarray(color_light)
+        color_plane0, color_plane1 = xp.asarray(color_plane0), xp.asarray(color_plane1)
+        rayD = xp.asarray(D.reshape(-1, 3))
+        col = xp.asnumpy(cast_ray(xp.broadcast_to(O, rayD.shape), rayD))
+    elif has_numba:
+        # Trace all the pixels at once, spread over the cores by prange.
+        rayD = D.reshape(-1, 3)
+        col = cast_ray_jit(O, rayD, spheres['position'], spheres['radius'],
+            spheres['color'], planes['position'], planes['normal'], bvh,
+            obj_material, L, color_light, color_plane0, color_plane1)
+    else:
+        # Trace one strip of rows per core, in separate processes since the
+        # NumPy renderer holds the GIL between array operations.
+        n_strips = os.cpu_count() or 1
+        rows = np.linspace(0, h, n_strips + 1).astype(int)
+        with ProcessPoolExecutor(n_strips) as executor:
+            col = np.concatenate(list(executor.map(render_strip, rows[:-1], rows[1:])))
+    # Quantize the colors to 8 bits in place, with rounding.
+    np.clip(col, 0, 1, out=col)
+    col *= 255
+    col += .5
+    # Screen rows go up while image rows go down.
+    img = col.astype(np.uint8).reshape(h, w, 3)[::-1]
 
-plt.imsave('fig.png', img)
\ No newline at end of file
+    plt.imsave('fig.png', img)